@@ -3,58 +3,85 @@ from pathlib import Path
 
 SOFA_PARQUET_PATH = "sofa_scores.parquet"
 
-def calc_sofa_coag(labs):
-    return labs.with_columns(
-        (
-            pl.when(pl.col("Platelets").is_null())
-            .then(None)
-            .when(pl.col("Platelets").struct.field("value") < 20)
-            .then(4)
-            .when(pl.col("Platelets").struct.field("value") < 50)
-            .then(3)
-            .when(pl.col("Platelets").struct.field("value") < 100)
-            .then(2)
-            .when(pl.col("Platelets").struct.field("value") < 150)
-            .then(1)
-            .otherwise(0)
-        ).alias("sofa_coag")
-    )
+## SCORING TABLES : each component is a list of criteria, the component score is the max over its criteria
+## value       : expression the thresholds apply to
+## breaks      : sorted bin edges, scores has one more entry than breaks (one score per bin, lowest bin first)
+## left_closed : True -> bins are [a, b) (strict "<" thresholds), False -> bins are (a, b] ("<=" thresholds)
+## only_if     : optional (condition, max_score), score is capped at max_score on rows where condition is not met
+SOFA_COAG = [
+    {"value": pl.col("Platelets").struct.field("value"), "breaks": [20, 50, 100, 150], "scores": [4, 3, 2, 1, 0], "left_closed": True},
+]
 
-def calc_sofa_liver(labs):
-    return labs.with_columns(
-        (
-            pl.when(pl.col("Bilirubin").is_null())
-            .then(None)
-            .when(pl.col("Bilirubin").struct.field("value") >= 12.0)
-            .then(4)
-            .when(pl.col("Bilirubin").struct.field("value") >= 6.0)
-            .then(3)
-            .when(pl.col("Bilirubin").struct.field("value") >= 2.0)
-            .then(2)
-            .when(pl.col("Bilirubin").struct.field("value") >= 1.2)
-            .then(1)
-            .otherwise(0)
-        ).alias("sofa_liver")
-    )
+SOFA_LIVER = [
+    {"value": pl.col("Bilirubin").struct.field("value"), "breaks": [1.2, 2.0, 6.0, 12.0], "scores": [0, 1, 2, 3, 4], "left_closed": True},
+]
 
-def calc_sofa_renal(labs):
-    return labs.with_columns(
-        (
-            pl.when(pl.col("Creatinine").is_null())
-            .then(None)
-            .when(pl.col("Creatinine").struct.field("value") >= 5.0)
-            .then(4)
-            .when(pl.col("Creatinine").struct.field("value") >= 3.5)
-            .then(3)
-            .when(pl.col("Creatinine").struct.field("value") >= 2.0)
-            .then(2)
-            .when(pl.col("Creatinine").struct.field("value") >= 1.2)
-            .then(1)
-            .otherwise(0)
-        ).alias("sofa_renal")
-    )
+SOFA_RENAL = [
+    {"value": pl.col("Creatinine").struct.field("value"), "breaks": [1.2, 2.0, 3.5, 5.0], "scores": [0, 1, 2, 3, 4], "left_closed": True},
+]
+
+## Scores 3 and 4 require respiratory support, non ventilated patients are capped at 2
+SOFA_RESP = [
+    {
+        "value": pl.col("pao2_fio2"), "breaks": [100, 200, 300, 400], "scores": [4, 3, 2, 1, 0], "left_closed": True,
+        "only_if": (pl.col("FiO2_ventilator").is_not_null(), 2),
+    },
+]
+
+## medicaton values in mcg/kg/min, doses <= 0 (unconvertible rates are imputed as 0) don't score
+SOFA_CARDIO = [
+    {"value": pl.col("MAP"), "breaks": [70], "scores": [1, 0], "left_closed": True},
+    {"value": pl.col("dobutamine"), "breaks": [0], "scores": [0, 2], "left_closed": False},
+    {"value": pl.col("dopamine"), "breaks": [0, 5, 15], "scores": [0, 2, 3, 4], "left_closed": False},
+    {"value": pl.col("norepinephrine"), "breaks": [0, 0.1], "scores": [0, 3, 4], "left_closed": False},
+    {"value": pl.col("epinephrine"), "breaks": [0, 0.1], "scores": [0, 3, 4], "left_closed": False},
+]
+
+def binned_score(criterion, missing=None):
+    # Generates the when/then chain from the table : one comparison per break, null values score missing
+    value, breaks, scores = criterion["value"], criterion["breaks"], criterion["scores"]
+    if len(scores) != len(breaks) + 1:
+        raise ValueError(f"Expected {len(breaks) + 1} scores for {len(breaks)} breaks, got {len(scores)}")
+    if list(breaks) != sorted(breaks):
+        raise ValueError(f"Breaks must be sorted, got {breaks}")
+
+    ## only_if : bins scoring above max_score are split into (bin & condition) -> score, bin -> max_score
+    condition, max_score = criterion.get("only_if", (None, None))
+    left_closed = criterion.get("left_closed", False)
+
+    def add_bin(chain, in_bin, score):
+        if condition is not None and score > max_score:
+            chain = chain.when(in_bin & condition).then(pl.lit(score, dtype=pl.Int32))
+            score = max_score
+        return chain.when(in_bin).then(pl.lit(score, dtype=pl.Int32))
+
+    chain = pl.when(value.is_null()).then(pl.lit(missing, dtype=pl.Int32))
+    for upper, score in zip(breaks, scores):
+        chain = add_bin(chain, value < upper if left_closed else value <= upper, score)
+
+    ## last bin is whatever is left over
+    if condition is not None and scores[-1] > max_score:
+        chain = chain.when(condition).then(pl.lit(scores[-1], dtype=pl.Int32))
+        return chain.otherwise(pl.lit(max_score, dtype=pl.Int32))
+    return chain.otherwise(pl.lit(scores[-1], dtype=pl.Int32))
+
+def compile_score(table, name):
+    # Component score is the highest score over all criteria, null if no criterion has a value
+    if len(table) == 1:
+        return binned_score(table[0]).alias(name)
+    ## max_horizontal is much slower on nulls, missing values score -1 and are set back to null afterwards
+    return pl.max_horizontal([binned_score(criterion, missing=-1) for criterion in table]).replace(-1, None).alias(name)
 
-def calc_sofa_respiratory(labs, respiratory):
+def calc_sofa_coag(labs, table=SOFA_COAG):
+    return labs.with_columns(compile_score(table, "sofa_coag"))
+
+def calc_sofa_liver(labs, table=SOFA_LIVER):
+    return labs.with_columns(compile_score(table, "sofa_liver"))
+
+def calc_sofa_renal(labs, table=SOFA_RENAL):
+    return labs.with_columns(compile_score(table, "sofa_renal"))
+
+def calc_sofa_respiratory(labs, respiratory, table=SOFA_RESP):
     fio2_mask = (
         pl.when(pl.col("FiO2_inhaled").is_not_null()).then(pl.col("FiO2_inhaled"))
         .when(pl.col("FiO2_ventilator").is_not_null()).then(pl.col("FiO2_ventilator"))
@@ -83,28 +110,19 @@ def calc_sofa_respiratory(labs, respiratory):
         tolerance=3600
     )
 
+    ## FiO2 is in percent, the SOFA PaO2/FiO2 breaks expect a fraction
     pao2_fio2_mask = (
         pl.when(pl.col("PaO2").is_not_null() & pl.col("FiO2").is_not_null())
-        .then(pl.col("PaO2").struct.field("value") / pl.col("FiO2"))
+        .then(pl.col("PaO2").struct.field("value") / (pl.col("FiO2") / 100))
         .otherwise(None)
     ).alias("pao2_fio2")
     fio2_data = fio2_data.with_columns(pao2_fio2_mask)
 
-    resp_score = (
-        pl.when(pl.col("pao2_fio2").is_null()).then(None)
-        .when(pl.col("pao2_fio2") >= 400).then(0)
-        .when(pl.col("pao2_fio2") < 400).then(1)
-        .when(pl.col("pao2_fio2") < 300).then(2)
-        .when((pl.col("pao2_fio2") < 200) & pl.col("FiO2_ventilator").is_not_null()).then(3)
-        .when((pl.col("pao2_fio2") < 100) & pl.col("FiO2_ventilator").is_not_null()).then(4)
-        .otherwise(0)
-    ).alias("sofa_resp")
-
     #x = fio2_data.filter(pl.col("PaO2").is_not_null() & pl.col("FiO2").is_not_null())
     #not_both_values = fio2_data.select(pl.col("id")).unique().join(x.select(pl.col("id")).unique(), on="id", how="anti")
-    return fio2_data.with_columns(resp_score)
+    return fio2_data.with_columns(compile_score(table, "sofa_resp"))
 
-def calc_sofa_cardio(vitals, meds, patients):
+def calc_sofa_cardio(vitals, meds, patients, table=SOFA_CARDIO):
     # Cardiovascular SOFA score calculation needs MAP and medication
 
     ## MAP CALCULATION : Uses invasive / non invasive MAP if available
@@ -202,33 +220,7 @@ def calc_sofa_cardio(vitals, meds, patients):
         tolerance=3600  # 1 hour tolerance
     )
 
-    cardio_sofa = ( ## medicaton values in mcg/kg/min
-        pl.when(pl.col("MAP").is_null() & pl.col("dobutamine").is_null() & pl.col("dopamine").is_null() & pl.col("norepinephrine").is_null() & pl.col("epinephrine").is_null())
-        .then(None)
-        .when(pl.col("MAP").is_not_null() & (pl.col("MAP") >= 70))
-        .then(0)
-        .when((pl.col("MAP").is_not_null() & (pl.col("MAP") < 70)))
-            .then(1)
-        .when(
-            (pl.col("dobutamine").is_not_null()) |
-            (pl.col("dopamine").is_not_null() & (pl.col("dopamine") <= 5)) 
-        )
-            .then(2)
-        .when(
-            (pl.col("dopamine").is_not_null() & (pl.col("dopamine") > 5)) |
-            (pl.col("norepinephrine").is_not_null() & (pl.col("norepinephrine") <= 0.1)) |
-            (pl.col("epinephrine").is_not_null() & (pl.col("epinephrine") <= 0.1))
-        )
-            .then(3)
-        .when(
-            (pl.col("dopamine").is_not_null() & (pl.col("dopamine") > 15)) |
-            (pl.col("norepinephrine").is_not_null() & (pl.col("norepinephrine") > 0.1)) |
-            (pl.col("epinephrine").is_not_null() & (pl.col("epinephrine") > 0.1))
-        ) 
-            .then(4)
-        .otherwise(None)
-    ).alias("sofa_cardio")
-    return cardio_df.with_columns(cardio_sofa)
+    return cardio_df.with_columns(compile_score(table, "sofa_cardio"))
 
 def calc_sofa(patients:pl.LazyFrame, vitals:pl.LazyFrame, meds:pl.LazyFrame, labs:pl.LazyFrame, respiratory:pl.LazyFrame) -> pl.LazyFrame:
     result = labs.rename({"Global ICU Stay ID": "id", "Time Relative to Admission (seconds)":"time"})
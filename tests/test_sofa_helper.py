@@ -0,0 +1,127 @@
+import polars as pl
+import pytest
+
+import sofa_helper
+
+
+def score(table, **columns):
+    df = pl.DataFrame(columns, schema={name: pl.Float64 for name in columns})
+    return df.select(sofa_helper.compile_score(table, "score"))["score"].to_list()
+
+
+def lab(values):
+    return [None if v is None else {"value": v} for v in values]
+
+
+def test_coag_bins_are_left_closed():
+    labs = pl.LazyFrame({"Platelets": lab([19.9, 20.0, 49.9, 50.0, 99.9, 100.0, 149.9, 150.0, None])})
+    result = sofa_helper.calc_sofa_coag(labs).collect()["sofa_coag"].to_list()
+    assert result == [4, 3, 3, 2, 2, 1, 1, 0, None]
+
+
+def test_liver_bins_are_left_closed():
+    labs = pl.LazyFrame({"Bilirubin": lab([1.1, 1.2, 1.9, 2.0, 5.9, 6.0, 11.9, 12.0, None])})
+    result = sofa_helper.calc_sofa_liver(labs).collect()["sofa_liver"].to_list()
+    assert result == [0, 1, 1, 2, 2, 3, 3, 4, None]
+
+
+def test_renal_bins_are_left_closed():
+    labs = pl.LazyFrame({"Creatinine": lab([1.1, 1.2, 1.9, 2.0, 3.4, 3.5, 4.9, 5.0, None])})
+    result = sofa_helper.calc_sofa_renal(labs).collect()["sofa_renal"].to_list()
+    assert result == [0, 1, 1, 2, 2, 3, 3, 4, None]
+
+
+def test_resp_bins_and_ventilation_cap():
+    ratios = [450, 400, 399, 300, 299, 200, 199, 100, 99, None]
+    result = score(
+        sofa_helper.SOFA_RESP,
+        pao2_fio2=ratios * 2,
+        FiO2_ventilator=[40.0] * len(ratios) + [None] * len(ratios),
+    )
+    ventilated = [0, 0, 1, 1, 2, 2, 3, 3, 4, None]
+    not_ventilated = [0, 0, 1, 1, 2, 2, 2, 2, 2, None]
+    assert result == ventilated + not_ventilated
+
+
+def test_resp_uses_fio2_fraction():
+    # PaO2 in mmHg, FiO2 in percent : 90 / 0.21 ~ 429, 90 / 0.40 = 225, 60 / 0.60 = 100, 60 / 0.80 = 75
+    labs = pl.LazyFrame({
+        "Global ICU Stay ID": ["a", "b", "c", "d"],
+        "Time Relative to Admission (seconds)": [0, 0, 0, 0],
+        "Oxygen": lab([90.0, 90.0, 60.0, 60.0]),
+    })
+    respiratory = pl.LazyFrame({
+        "Global ICU Stay ID": ["a", "b", "c", "d"],
+        "Time Relative to Admission (seconds)": [0, 0, 0, 0],
+        "Oxygen gas flow Oxygen delivery system": [None, None, None, None],
+        "Oxygen/Gas total [Pure volume fraction] Inhaled gas": [None, 40.0, None, None],
+        "Oxygen/Total gas setting [Volume Fraction] Ventilator": [None, None, 60.0, 80.0],
+    }, schema_overrides={
+        "Oxygen gas flow Oxygen delivery system": pl.Float64,
+        "Oxygen/Gas total [Pure volume fraction] Inhaled gas": pl.Float64,
+        "Oxygen/Total gas setting [Volume Fraction] Ventilator": pl.Float64,
+    })
+    result = sofa_helper.calc_sofa_respiratory(labs, respiratory).sort("id").collect()
+    assert result["pao2_fio2"].to_list() == pytest.approx([90 / 0.21, 225.0, 100.0, 75.0])
+    assert result["sofa_resp"].to_list() == [0, 2, 3, 4]
+
+
+def test_cardio_map_only():
+    none = [None] * 3
+    result = score(
+        sofa_helper.SOFA_CARDIO,
+        MAP=[69.9, 70.0, None], dobutamine=none, dopamine=none, norepinephrine=none, epinephrine=none,
+    )
+    assert result == [1, 0, None]
+
+
+def test_cardio_drug_bins_are_right_closed():
+    result = score(
+        sofa_helper.SOFA_CARDIO,
+        MAP=[80.0] * 6,
+        dobutamine=[None] * 6,
+        dopamine=[0.0, 5.0, 5.1, 15.0, 15.1, None],
+        norepinephrine=[None, None, None, None, None, 0.1],
+        epinephrine=[None, None, None, None, None, None],
+    )
+    assert result == [0, 2, 3, 3, 4, 3]
+
+
+def test_cardio_zero_doses_do_not_score():
+    result = score(
+        sofa_helper.SOFA_CARDIO,
+        MAP=[80.0] * 4,
+        dobutamine=[0.0, None, None, None],
+        dopamine=[None, 0.0, None, None],
+        norepinephrine=[None, None, 0.0, None],
+        epinephrine=[None, None, None, 0.0],
+    )
+    assert result == [0, 0, 0, 0]
+
+
+def test_cardio_is_max_over_criteria():
+    result = score(
+        sofa_helper.SOFA_CARDIO,
+        MAP=[60.0, 80.0, 80.0, None],
+        dobutamine=[None, 2.0, 2.0, None],
+        dopamine=[None, None, None, None],
+        norepinephrine=[None, None, 0.2, None],
+        epinephrine=[0.05, None, None, 0.1],
+    )
+    assert result == [3, 2, 4, 3]
+
+
+def test_only_if_caps_scores_when_condition_is_not_met():
+    table = [{
+        "value": pl.col("x"), "breaks": [1, 2], "scores": [0, 3, 4], "left_closed": True,
+        "only_if": (pl.col("flag").is_not_null(), 1),
+    }]
+    result = score(table, x=[0.0, 1.5, 2.5, 0.0, 1.5, 2.5, None], flag=[1.0, 1.0, 1.0, None, None, None, None])
+    assert result == [0, 3, 4, 0, 1, 1, None]
+
+
+def test_invalid_tables_raise():
+    with pytest.raises(ValueError):
+        sofa_helper.compile_score([{"value": pl.col("x"), "breaks": [1, 2], "scores": [0, 1]}], "score")
+    with pytest.raises(ValueError):
+        sofa_helper.compile_score([{"value": pl.col("x"), "breaks": [2, 1], "scores": [0, 1, 2]}], "score")